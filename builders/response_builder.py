@@ -6,6 +6,72 @@ HTTP响应构建器
 负责构建HTTP响应，包括错误响应和正常响应。
 """
 
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 把头部值中的裸CR/LF替换为空格的转换表
+# 先用in做包含检查（C级memchr，干净头部近乎零开销），
+# 命中时一次translate完成两种字符的替换，避免两次replace两份中间字符串
+_HDR_SANITIZE = str.maketrans({"\r": " ", "\n": " "})
+
+# 响应侧不透传的hop-by-hop头部（RFC 7230 §6.1）：
+# 这些头部只描述代理与目标服务器之间那一跳的连接，
+# 统一用一次frozenset成员测试替代头部循环里的多个字符串比较。
+# Transfer-Encoding也在其中——chunked编码已由urllib3解码，
+# 不能再对客户端声明
+_HOP_BY_HOP = frozenset(
+    {
+        "connection",
+        "proxy-connection",
+        "proxy-authenticate",
+        "keep-alive",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    }
+)
+
+
+def _build_error_response(status_code: int, message: str) -> bytes:
+    """
+    构建HTTP错误响应字节串
+
+    Args:
+        status_code: HTTP状态码（如400, 500等）
+        message: 错误消息
+
+    Returns:
+        bytes: 编码后的错误响应
+    """
+    # 构建错误响应体
+    body = message.encode("utf-8")
+
+    # 直接在bytearray中累加响应字节：
+    # 相比先构建字符串列表、join、encode再拼接body的方式，
+    # 整个响应只增长一个缓冲区，没有中间字符串拷贝
+    buf = bytearray()
+    buf += f"HTTP/1.1 {status_code} {message}\r\n".encode("utf-8")
+    buf += b"Content-Type: text/plain; charset=utf-8\r\n"
+    buf += b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n"
+    buf += b"Connection: close\r\n\r\n"
+    buf += body
+    return bytes(buf)
+
+
+# 固定内容的错误响应在模块加载时构建一次，
+# 之后每次失败的请求直接返回缓存好的字节串，不再重复编码
+_STATIC_ERRORS = {
+    (code, msg): _build_error_response(code, msg)
+    for code, msg in (
+        (400, "Bad Request: Unable to parse request"),
+        (400, "Bad Request: No Host header"),
+        (502, "Bad Gateway"),
+        (504, "Gateway Timeout"),
+    )
+}
+
 
 class ResponseBuilder:
     """HTTP响应构建器"""
@@ -15,6 +81,9 @@ class ResponseBuilder:
         """
         创建HTTP错误响应
 
+        常见的固定错误响应直接命中模块级缓存；
+        带动态内容的错误消息（如包含目标主机名）仍实时构建。
+
         Args:
             status_code: HTTP状态码（如400, 500等）
             message: 错误消息
@@ -22,172 +91,134 @@ class ResponseBuilder:
         Returns:
             bytes: 编码后的错误响应
         """
-        # 构建错误响应体
-        body = message.encode("utf-8")
-
-        # 构建响应头部
-        response_headers = [
-            f"HTTP/1.1 {status_code} {message}",
-            "Content-Type: text/plain; charset=utf-8",
-            f"Content-Length: {len(body)}",
-            "Connection: close",
-            "",  # 空行
-        ]
-
-        # 组合响应
-        response = "\r\n".join(response_headers).encode("utf-8") + body
-        return response
+        cached = _STATIC_ERRORS.get((status_code, message))
+        if cached is not None:
+            return cached
+        return _build_error_response(status_code, message)
+
+    @staticmethod
+    def build_stream_headers(response) -> tuple:
+        """
+        为流式转发构建响应头部
+
+        流式路径不在代理侧解码body：gzip等压缩内容原样透传，
+        因此Content-Encoding头部保留；chunked编码已由urllib3解码，
+        所以Transfer-Encoding头部移除。目标服务器给出Content-Length时
+        沿用原值（body字节原样转发，长度不变）；没有Content-Length时
+        退化为Connection: close，以连接关闭作为响应结束的定界。
+
+        Args:
+            response: requests.Response对象（stream=True）
+
+        Returns:
+            tuple: (头部bytes, 发送完body后是否需要关闭连接)
+        """
+        reason = response.reason if response.reason else "OK"
+        reason = reason.replace("\r", "").replace("\n", "")
+
+        buf = bytearray()
+        buf += f"HTTP/1.1 {response.status_code} {reason}\r\n".encode("utf-8")
+
+        raw_headers = getattr(response.raw, "headers", None)
+        if raw_headers is not None:
+            header_items = raw_headers.items()
+        else:
+            header_items = response.headers.items()
+
+        has_content_length = False
+        for key, value in header_items:
+            lower_key = key.lower()
+
+            # hop-by-hop头部（含Transfer-Encoding）不透传，
+            # 连接语义由代理自己决定
+            if lower_key in _HOP_BY_HOP:
+                continue
+
+            if lower_key == "content-length":
+                has_content_length = True
+
+            # 移除值中的换行符（HTTP规范不允许）
+            if "\r" in value or "\n" in value:
+                value = value.translate(_HDR_SANITIZE)
+
+            buf += f"{key}: {value}\r\n".encode("utf-8")
+
+        # 没有Content-Length时只能以关闭连接来标记响应结束
+        close_after = not has_content_length
+        if close_after:
+            buf += b"Connection: close\r\n"
+
+        buf += b"\r\n"
+        return bytes(buf), close_after
 
     @staticmethod
     def build_from_requests_response(response) -> bytes:
         """
         从requests库的Response对象构建HTTP响应
 
+        单次遍历响应头部，边遍历边写入bytearray：
+        requests库已经自动解码了chunked编码和gzip压缩，所以
+        Transfer-Encoding、已解压的Content-Encoding头部直接跳过，
+        Content-Length统一在最后按实际body大小写入一次。
+
         Args:
             response: requests.Response对象
 
         Returns:
             bytes: 编码后的HTTP响应
         """
-        response_headers = []
         # 状态行：HTTP版本 状态码 状态文本
         # 清理reason中的换行符和特殊字符
         reason = response.reason if response.reason else "OK"
         reason = reason.replace("\r", "").replace("\n", "")
-        response_headers.append(f"HTTP/1.1 {response.status_code} {reason}")
-
-        # 添加所有响应头部
-        # 确保头部格式正确：Key: Value
-        # 清理头部值中的换行符（HTTP头部值不应该包含换行符）
-
-        # 重要：处理编码相关的头部
-        # requests库已经自动解码了chunked编码和gzip压缩
-        # 所以response.content是完整的、解压后的body
-        # 我们需要：
-        # 1. 移除Transfer-Encoding头部
-        # 2. 移除Content-Encoding头部（如果已解压）
-        # 3. 更新Content-Length为实际body大小
-        content_length_value = len(response.content)  # 实际body大小（已解压）
-
-        # 先检查是否有gzip编码
-        has_content_encoding_gzip = False
-        for key, value in list(response.headers.items()):
-            key_str_check = str(key).strip().lower()
-            if key_str_check == "content-encoding":
-                encoding_value = str(value).strip().lower()
-                if "gzip" in encoding_value or "deflate" in encoding_value:
-                    has_content_encoding_gzip = True
-                    break
 
-        for key, value in response.headers.items():
-            # 确保key和value都是字符串
-            original_key = str(key).strip()
-            key_str = original_key.lower()  # 转换为小写以便比较
-            value_str = str(value).strip()
+        # response.content是完整的、解压后的body
+        content = response.content
+
+        buf = bytearray()
+        buf += f"HTTP/1.1 {response.status_code} {reason}\r\n".encode("utf-8")
+
+        # 优先使用urllib3层的原始头部（保留顺序和重复头部）；
+        # 没有raw时（如测试替身）退回requests的头部字典
+        raw = getattr(response, "raw", None)
+        raw_headers = getattr(raw, "headers", None)
+        if raw_headers is not None:
+            header_items = raw_headers.items()
+        else:
+            header_items = response.headers.items()
+
+        for key, value in header_items:
+            # 每个键只计算一次小写形式
+            lower_key = key.lower()
 
-            # 跳过空的key
-            if not key_str:
+            # 跳过hop-by-hop头部（含已被解码的Transfer-Encoding）
+            if lower_key in _HOP_BY_HOP:
                 continue
 
-            # 跳过Transfer-Encoding头部（因为我们已经解码了chunked编码）
-            if key_str == "transfer-encoding":
+            # Content-Length统一在循环结束后写入实际body大小
+            if lower_key == "content-length":
                 continue
 
-            # 跳过Content-Encoding头部（如果已解压，如gzip）
-            # requests库会自动解压gzip，所以我们需要移除这个头部
-            if key_str == "content-encoding":
-                encoding_value = value_str.lower()
-                # 如果已解压（requests自动解压），移除这个头部
+            # 跳过已解压的Content-Encoding头部（gzip/deflate）
+            if lower_key == "content-encoding":
+                encoding_value = value.lower()
                 if "gzip" in encoding_value or "deflate" in encoding_value:
-                    print(
-                        f"  跳过Content-Encoding头部（已自动解压）: {original_key}"
-                    )
                     continue
 
-            # 记录是否有Content-Length头部，并更新为实际body大小
-            if key_str == "content-length":
-                old_value = value_str
-                value_str = str(content_length_value)
-                if old_value != value_str:
-                    print(
-                        f"  更新Content-Length: {old_value} -> {value_str} (body实际大小)"
-                    )
-                else:
-                    print(f"  Content-Length已正确: {value_str}")
-
             # 移除值中的换行符（HTTP规范不允许）
-            value_str = value_str.replace("\r", " ").replace("\n", " ")
-
-            # 构建头部行：Key: Value
-            header_line = f"{original_key}: {value_str}"
-            response_headers.append(header_line)
-
-        # 强制设置Content-Length为实际body大小
-        # 无论原来是否有Content-Length头部，都确保它是正确的
-        if content_length_value > 0:
-            # 删除所有现有的Content-Length头部（可能有多个或错误的值）
-            response_headers = [
-                h
-                for h in response_headers
-                if not h.lower().startswith("content-length:")
-            ]
-
-            # 在空行之前插入正确的Content-Length头部
-            # 找到空行的位置（如果还没有空行，会在后面添加）
-            empty_line_idx = -1
-            for i, header_line in enumerate(response_headers):
-                if not header_line.strip():
-                    empty_line_idx = i
-                    break
-
-            if empty_line_idx > 0:
-                response_headers.insert(
-                    empty_line_idx, f"Content-Length: {content_length_value}"
-                )
-            else:
-                # 如果没有空行，在最后添加（空行会在后面添加）
-                response_headers.append(f"Content-Length: {content_length_value}")
-
-            print(
-                f"  强制设置Content-Length头部为: {content_length_value} 字节"
+            if "\r" in value or "\n" in value:
+                value = value.translate(_HDR_SANITIZE)
+
+            buf += f"{key}: {value}\r\n".encode("utf-8")
+
+        # 写入正确的Content-Length和头部结束空行，然后直接追加body
+        buf += f"Content-Length: {len(content)}\r\n\r\n".encode("utf-8")
+        buf += content
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "收到响应: %s %s (body %d 字节, 总计 %d 字节)",
+                response.status_code, reason, len(content), len(buf),
             )
 
-        # 空行分隔头部和body
-        response_headers.append("")
-
-        # 组合响应：头部 + 空行 + body
-        # 使用 \r\n 作为行分隔符（HTTP标准要求）
-        response_header_text = "\r\n".join(response_headers)
-        # 确保头部以 \r\n\r\n 结尾（HTTP标准要求）
-        # join() 不会在最后添加分隔符，所以需要手动添加 \r\n
-        if not response_header_text.endswith("\r\n\r\n"):
-            # 如果最后不是 \r\n\r\n，添加它
-            if response_header_text.endswith("\r\n"):
-                # 如果最后是 \r\n，再添加一个 \r\n
-                response_header_text += "\r\n"
-            else:
-                # 如果最后不是 \r\n，添加 \r\n\r\n
-                response_header_text += "\r\n\r\n"
-
-        header_bytes = response_header_text.encode("utf-8")
-        body_bytes = response.content
-
-        response_data = header_bytes + body_bytes
-
-        # 调试信息
-        print(f"  调试：响应头部大小 = {len(header_bytes)} 字节")
-        print(f"  调试：响应体大小 = {len(body_bytes)} 字节")
-        print(f"  调试：总响应大小 = {len(response_data)} 字节")
-
-        # 调试：打印响应头部信息（用于排查问题）
-        if len(response_headers) > 0:
-            debug_lines = response_headers[: min(5, len(response_headers))]
-            print(f"[OK] 收到响应: {response.status_code} {reason}")
-            print(f"  响应头部（前{len(debug_lines)}行）: {debug_lines}")
-            # 查找Content-Length头部
-            for line in response_headers:
-                if line.lower().startswith("content-length:"):
-                    print(f"  最终Content-Length头部: {line}")
-                    break
-
-        return response_data
+        return bytes(buf)
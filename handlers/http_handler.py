@@ -6,10 +6,31 @@ HTTP请求处理器
 负责处理HTTP请求的转发和响应。
 """
 
+import logging
+import socket
+
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Dict, Optional
 from builders.response_builder import ResponseBuilder
 
+logger = logging.getLogger(__name__)
+
+# hop-by-hop头部（RFC 7230 §6.1）只对当前这一跳连接有意义，
+# 代理不应该原样转发；统一用小写与头部键的.lower()比较
+_HOP_BY_HOP = frozenset(
+    {
+        "connection",
+        "proxy-connection",
+        "proxy-authorization",
+        "keep-alive",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    }
+)
+
 
 class HTTPHandler:
     """HTTP请求处理器"""
@@ -18,26 +39,53 @@ class HTTPHandler:
         """初始化HTTP处理器"""
         self.response_builder = ResponseBuilder()
 
-    def handle(self, request_info: Dict) -> Optional[bytes]:
+        # 使用持久的Session转发请求，复用到同一目标服务器的TCP连接
+        # 每次调用requests.request()都会新建连接池、做DNS解析和TCP握手，
+        # 而Session配合连接池可以把这些开销分摊到多个请求上
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=64,  # 最多缓存64个目标主机的连接池
+            pool_maxsize=32,  # 每个目标主机最多保持32个连接
+            max_retries=0,  # 代理不做自动重试，由客户端决定
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # 流式转发时单次读取的块大小
+    STREAM_CHUNK_SIZE = 65536
+
+    def close(self) -> None:
+        """关闭Session，释放连接池中缓存的所有上游连接"""
+        self.session.close()
+
+    def handle(
+        self, request_info: Dict, client_socket: socket.socket
+    ) -> Optional[bytes]:
         """
-        处理HTTP请求，转发到目标服务器并返回响应
+        处理HTTP请求，转发到目标服务器并把响应流式写回客户端
+
+        目标服务器的响应不再整体读入内存：头部构建好后立即发给客户端，
+        body按块从上游读出、按块写入客户端socket。无论响应多大，
+        代理占用的内存都是常数，客户端也能更早收到第一个字节。
 
         Args:
             request_info: 解析后的请求信息字典
+            client_socket: 与客户端的socket连接
 
         Returns:
-            bytes: 目标服务器的响应数据（HTTP响应格式），如果出错则返回错误响应
+            Optional[bytes]: None表示响应已直接写入client_socket；
+                出错时返回待发送的错误响应bytes
         """
         try:
             method = request_info.get("method")
             url = request_info.get("url")
-            headers = request_info.get("headers", {}).copy()
-            body = request_info.get("body", "")
+            headers = request_info.get("headers", {})
+            body = request_info.get("body", b"")  # 请求体是bytes，转发时无需解码
             target_host = request_info.get("target_host")
 
             # 检查是否有目标主机
             if not target_host:
-                print("[ERROR] 错误：无法确定目标主机（缺少Host头部）")
+                logger.error("无法确定目标主机（缺少Host头部）")
                 return self.response_builder.create_error_response(
                     400, "Bad Request: No Host header"
                 )
@@ -52,49 +100,114 @@ class HTTPHandler:
                 # 注意：这里只支持HTTP，HTTPS需要CONNECT隧道
                 full_url = f"http://{target_host}{url}"
 
-            print(f"[SEND] 转发请求: {method} {full_url}")
+            logger.info("转发请求: %s %s", method, full_url)
 
-            # 移除一些不应该转发的代理相关头部
-            # Connection: 控制连接行为，不应该转发
-            # Proxy-Connection: 代理专用头部，不应该转发
-            headers.pop("Connection", None)
-            headers.pop("Proxy-Connection", None)
-            headers.pop("Proxy-Authorization", None)  # 代理认证信息，不应该转发
+            # 一次遍历过滤掉所有hop-by-hop头部（大小写不敏感），
+            # 替代原来逐个pop的方式——小写的 connection: 也能被正确移除
+            headers = {
+                key: value
+                for key, value in headers.items()
+                if key.lower() not in _HOP_BY_HOP
+            }
 
-            # 使用requests库转发请求
+            # 使用持久Session转发请求
             # requests库会自动处理很多HTTP细节，比手动构建socket连接简单
             try:
-                response = requests.request(
+                response = self.session.request(
                     method=method,  # 请求方法（GET, POST等）
                     url=full_url,  # 完整URL
                     headers=headers,  # 请求头部
                     data=body if body else None,  # 请求体（如果有）
                     allow_redirects=False,  # 不自动跟随重定向（让客户端自己处理）
                     timeout=30,  # 30秒超时
-                    stream=False,  # 不使用流式传输，直接获取完整响应
+                    stream=True,  # 流式传输，body按块转发而不是整体读入内存
                 )
 
-                # 使用ResponseBuilder构建响应
-                return self.response_builder.build_from_requests_response(response)
+                return self._stream_response(response, client_socket, request_info)
 
             except requests.exceptions.Timeout:
-                print("[ERROR] 错误：请求超时")
+                logger.error("请求超时")
                 return self.response_builder.create_error_response(
                     504, "Gateway Timeout"
                 )
             except requests.exceptions.ConnectionError:
-                print(f"[ERROR] 错误：无法连接到目标服务器 {target_host}")
+                logger.error("无法连接到目标服务器 %s", target_host)
                 return self.response_builder.create_error_response(
                     502, f"Bad Gateway: Cannot connect to {target_host}"
                 )
             except requests.exceptions.RequestException as e:
-                print(f"[ERROR] 转发请求时出错: {e}")
+                logger.error("转发请求时出错: %s", e)
                 return self.response_builder.create_error_response(
                     502, f"Bad Gateway: {str(e)}"
                 )
 
         except Exception as e:
-            print(f"[ERROR] 处理请求时出错: {e}")
+            logger.error("处理请求时出错: %s", e)
             return self.response_builder.create_error_response(
                 500, f"Internal Server Error: {str(e)}"
             )
+
+    def _stream_response(
+        self,
+        response: requests.Response,
+        client_socket: socket.socket,
+        request_info: Dict,
+    ) -> Optional[bytes]:
+        """
+        把上游响应流式写入客户端socket
+
+        Args:
+            response: requests.Response对象（stream=True）
+            client_socket: 与客户端的socket连接
+            request_info: 请求信息字典；响应以Connection: close定界时
+                在其中记上connection_close，调用方据此结束keep-alive
+
+        Returns:
+            Optional[bytes]: None表示已成功流式发送；
+                无法流式处理时返回完整的缓冲响应bytes
+        """
+        try:
+            # 个别适配器（如测试替身）没有底层raw流，退回缓冲模式
+            if response.raw is None:
+                return self.response_builder.build_from_requests_response(response)
+
+            header_bytes, close_after = self.response_builder.build_stream_headers(
+                response
+            )
+
+            # 没有Content-Length的响应以关闭连接作为结束标记，
+            # 发送完body后客户端连接必须关闭，不能再keep-alive
+            if close_after:
+                request_info["connection_close"] = True
+
+            # 头部一旦开始发送，这个socket上就不允许再出现第二个响应：
+            # 无论是客户端断开（socket.error）还是上游中途断流
+            # （urllib3的ProtocolError等），都只能记日志、标记关闭连接
+            # 并放弃——把500混进转发到一半的body里，客户端会把错误
+            # 响应的字节计入200的Content-Length，得到一个看似成功
+            # 实则损坏的响应
+            try:
+                client_socket.sendall(header_bytes)
+
+                # body按块透传：decode_content=False保证gzip等压缩内容
+                # 原样转发，与头部中保留的Content-Encoding/Content-Length一致
+                total = 0
+                for chunk in response.raw.stream(
+                    self.STREAM_CHUNK_SIZE, decode_content=False
+                ):
+                    if chunk:
+                        client_socket.sendall(chunk)
+                        total += len(chunk)
+
+                logger.debug(
+                    "响应流式转发完成: %s (%d 字节)", response.status_code, total
+                )
+            except Exception as e:
+                logger.error("流式转发响应中断: %s", e)
+                request_info["connection_close"] = True
+
+            return None
+
+        finally:
+            # 归还连接到Session的连接池
+            response.close()
@@ -6,16 +6,29 @@ HTTPS请求处理器
 负责处理HTTPS CONNECT请求，建立隧道并转发加密数据。
 """
 
+import errno
+import logging
+import os
 import socket
-import select
+import selectors
+import threading
+import time
 from typing import Dict, Tuple, Optional
 from builders.response_builder import ResponseBuilder
 from utils.logger import RequestLogger
 
+logger = logging.getLogger(__name__)
+
 
 class HTTPSHandler:
     """HTTPS请求处理器"""
 
+    # DNS缓存条目的有效期（秒）
+    DNS_TTL = 60
+
+    # 缓存的主机数上限，超过时整体清空（防止被海量不同主机撑爆内存）
+    DNS_CACHE_MAX = 1024
+
     def __init__(self, logger: RequestLogger):
         """
         初始化HTTPS处理器
@@ -26,6 +39,11 @@ class HTTPSHandler:
         self.logger = logger
         self.response_builder = ResponseBuilder()
 
+        # DNS解析缓存：host -> (IP地址, 过期时间)
+        # 同一目标主机在TTL内的重复CONNECT不再走getaddrinfo，
+        # 省掉每次建立隧道前的一次阻塞解析
+        self._dns_cache = {}
+
     def handle(
         self, request_info: Dict, client_socket: socket.socket
     ) -> Optional[bytes]:
@@ -46,31 +64,27 @@ class HTTPSHandler:
             bytes: 成功响应或错误响应，如果隧道已建立则返回None
         """
         try:
-            # 从URL中提取目标主机和端口
-            # CONNECT请求的URL格式通常是 host:port
-            url = request_info.get("url", "")
-            print(f"  CONNECT目标: {url}")
-
-            # 解析主机和端口
-            if ":" in url:
-                host, port_str = url.split(":", 1)
-                try:
-                    port = int(port_str)
-                except ValueError:
-                    port = 443  # HTTPS默认端口
-            else:
-                host = url
-                port = 443  # HTTPS默认端口
+            # 目标主机和端口已经由解析器从CONNECT请求行解析好
+            # （包括IPv6字面量的处理），这里直接取用
+            logger.debug("CONNECT目标: %s", request_info.get("url", ""))
+            host = request_info.get("target_host", "")
+            port = request_info.get("target_port", 443)
 
-            print(f"  尝试连接到 {host}:{port}")
+            logger.debug("尝试连接到 %s:%s", host, port)
 
-            # 连接到目标服务器
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.settimeout(30)  # 30秒超时
+            # create_connection失败时会自己清理socket；
+            # 置None以便错误分支只关闭已经建立的连接
+            target_socket = None
 
             try:
-                target_socket.connect((host, port))
-                print(f"  [OK] 成功连接到 {host}:{port}")
+                target_socket = self._connect_target(host, port)
+                logger.info("成功连接到 %s:%s", host, port)
+
+                # 对隧道两端做TCP调优（禁用Nagle等）
+                # TLS握手是一串小数据帧，Nagle算法会把它们攒起来等ACK，
+                # 每个方向平白增加几十毫秒延迟
+                self._tune_tunnel_socket(target_socket)
+                self._tune_tunnel_socket(client_socket)
 
                 # 更新request_info以记录隧道建立
                 request_info["tunnel_established"] = True
@@ -80,46 +94,115 @@ class HTTPSHandler:
                 try:
                     client_address = client_socket.getpeername()
                     self.logger.log(request_info, client_address)
-                    print(f"[OK] 已记录CONNECT请求")
+                    logger.debug("已记录CONNECT请求")
                 except Exception as e:
-                    print(f"[ERROR] 记录CONNECT日志时出错: {e}")
+                    logger.error("记录CONNECT日志时出错: %s", e)
 
                 # 发送200响应给客户端，表示隧道建立成功
                 connect_response = "HTTP/1.1 200 Connection established\r\n\r\n"
                 client_socket.send(connect_response.encode("utf-8"))
-                print(f"  [OK] 已发送隧道建立响应给客户端")
-
-                # 开始双向数据转发
-                self._relay_data(client_socket, target_socket, host, port)
+                logger.debug("已发送隧道建立响应给客户端")
+
+                # 把双向转发放到独立的守护线程里：隧道可能存活几分钟
+                # （长连接、WebSocket等），不能一直占着accept循环。
+                # 转发线程负责在结束时关闭两端socket，
+                # 调用方看到tunnel_detached标记后不再关闭client_socket
+                relay_thread = threading.Thread(
+                    target=self._relay_data,
+                    args=(client_socket, target_socket, host, port),
+                    name=f"tunnel-{host}:{port}",
+                    daemon=True,
+                )
+                relay_thread.start()
+                request_info["tunnel_detached"] = True
 
-                # 返回None，表示隧道已建立并处理完成
+                # 返回None，表示隧道已建立并交由转发线程处理
                 return None
 
             except socket.timeout:
-                print(f"[ERROR] 连接超时: {host}:{port}")
-                target_socket.close()
+                logger.error("连接超时: %s:%s", host, port)
+                if target_socket is not None:
+                    target_socket.close()
                 return self.response_builder.create_error_response(
                     504, f"Gateway Timeout: Connection to {host}:{port} timed out"
                 )
             except socket.error as e:
-                print(f"[ERROR] 连接失败: {host}:{port} - {e}")
-                target_socket.close()
+                logger.error("连接失败: %s:%s - %s", host, port, e)
+                if target_socket is not None:
+                    target_socket.close()
                 return self.response_builder.create_error_response(
                     502, f"Bad Gateway: Cannot connect to {host}:{port}"
                 )
             except Exception as e:
-                print(f"[ERROR] 连接异常: {host}:{port} - {e}")
-                target_socket.close()
+                logger.error("连接异常: %s:%s - %s", host, port, e)
+                if target_socket is not None:
+                    target_socket.close()
                 return self.response_builder.create_error_response(
                     502, f"Bad Gateway: {str(e)}"
                 )
 
         except Exception as e:
-            print(f"[ERROR] 处理CONNECT请求时出错: {e}")
+            logger.error("处理CONNECT请求时出错: %s", e)
             return self.response_builder.create_error_response(
                 500, f"Internal Server Error: {str(e)}"
             )
 
+    def _connect_target(self, host: str, port: int) -> socket.socket:
+        """
+        连接目标服务器（带TTL的DNS缓存）
+
+        首次连接后把实际使用的对端IP缓存60秒，期间对同一主机的
+        CONNECT直接用IP连接，跳过getaddrinfo；缓存的IP连不上时
+        作废缓存条目并退回正常域名解析。
+
+        Args:
+            host: 目标主机名或IP
+            port: 目标端口
+
+        Returns:
+            socket.socket: 已建立的到目标服务器的连接
+        """
+        now = time.monotonic()
+        entry = self._dns_cache.get(host)
+        if entry is not None and now < entry[1]:
+            try:
+                return socket.create_connection((entry[0], port), timeout=30)
+            except OSError:
+                # 缓存的地址失效（服务器换了IP等），重新解析
+                self._dns_cache.pop(host, None)
+
+        # create_connection内部走getaddrinfo，自动支持IPv6目标
+        target_socket = socket.create_connection((host, port), timeout=30)
+
+        if len(self._dns_cache) >= self.DNS_CACHE_MAX:
+            self._dns_cache.clear()
+        self._dns_cache[host] = (
+            target_socket.getpeername()[0],
+            now + self.DNS_TTL,
+        )
+        return target_socket
+
+    @staticmethod
+    def _tune_tunnel_socket(sock: socket.socket) -> None:
+        """
+        对隧道socket做TCP层调优
+
+        - TCP_NODELAY: 禁用Nagle算法，小数据帧（TLS握手）立即发出
+        - SO_KEEPALIVE: 打开TCP保活，及时发现半开连接
+        - TCP_QUICKACK: （仅Linux）立即回ACK，减少握手往返延迟
+
+        Args:
+            sock: 需要调优的socket
+        """
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_QUICKACK"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except OSError as e:
+            # 调优失败不影响隧道功能，记一条调试日志即可
+            logger.debug("socket调优失败: %s", e)
+
     def _relay_data(
         self,
         client_socket: socket.socket,
@@ -141,77 +224,283 @@ class HTTPSHandler:
             host: 目标主机（用于日志）
             port: 目标端口（用于日志）
         """
-        print(f"  [SEND] 开始HTTPS隧道数据转发 ({host}:{port})")
+        # Linux上优先使用splice做零拷贝转发：数据直接在内核里从一个socket
+        # 移动到另一个socket，不经过用户态的Python bytes对象
+        if hasattr(os, "splice"):
+            if self._relay_data_splice(client_socket, target_socket, host, port):
+                return
+
+        # 非Linux平台（或splice不可用）回退到recv/send转发
+        self._relay_data_select(client_socket, target_socket, host, port)
+
+    def _relay_data_splice(
+        self,
+        client_socket: socket.socket,
+        target_socket: socket.socket,
+        host: str,
+        port: int,
+    ) -> bool:
+        """
+        使用splice在内核空间双向转发数据（仅Linux）
+
+        普通的recv/send转发要把每个字节从内核拷贝到用户态再拷贝回内核，
+        对于代理根本不关心内容的TLS密文来说是纯粹的浪费。splice借助一个
+        pipe把数据在内核里从源socket移动到目标socket，全程零拷贝。
+
+        Args:
+            client_socket: 与客户端的socket连接
+            target_socket: 与目标服务器的socket连接
+            host: 目标主机（用于日志）
+            port: 目标端口（用于日志）
+
+        Returns:
+            bool: True表示隧道已处理完毕；False表示splice不可用
+                （尚未转发任何数据），调用方应回退到recv/send路径
+        """
+        logger.debug("开始HTTPS隧道数据转发 (%s:%s, splice零拷贝)", host, port)
+
+        # 单次splice的最大字节数（1MB，数据停留在内核pipe缓冲区中）
+        SPLICE_MAX = 1 << 20
+
+        # 为每个转发方向创建一个pipe：
+        # socket -> pipe写端，pipe读端 -> 对端socket
+        try:
+            c2t_r, c2t_w = os.pipe()  # 客户端 -> 目标服务器
+            t2c_r, t2c_w = os.pipe()  # 目标服务器 -> 客户端
+        except OSError:
+            return False
+
+        sel = selectors.DefaultSelector()
+        client_bytes = 0  # 客户端 -> 目标服务器
+        server_bytes = 0  # 目标服务器 -> 客户端
+        handled = True
 
         try:
-            # 设置socket为非阻塞模式，这样可以使用select进行多路复用
+            # 非阻塞模式配合selector进行事件驱动的转发
             client_socket.setblocking(False)
             target_socket.setblocking(False)
 
-            # 数据缓冲区大小
-            BUFFER_SIZE = 4096
+            # data字段保存（对端socket, pipe读端, pipe写端）
+            sel.register(
+                client_socket, selectors.EVENT_READ, (target_socket, c2t_r, c2t_w)
+            )
+            sel.register(
+                target_socket, selectors.EVENT_READ, (client_socket, t2c_r, t2c_w)
+            )
+
+            splice_flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
 
-            # 使用select进行多路复用，同时监听两个socket
             while True:
-                # 等待socket可读或可写
-                readable, writable, exceptional = select.select(
-                    [client_socket, target_socket],  # 可读的socket
-                    [client_socket, target_socket],  # 可写的socket
-                    [client_socket, target_socket],  # 异常的socket
-                    1.0,  # 1秒超时
+                events = sel.select(timeout=30)
+
+                # 超时没有任何数据，认为隧道已空闲，关闭连接
+                if not events:
+                    logger.debug("隧道空闲超时，关闭连接")
+                    return True
+
+                for key, _ in events:
+                    sock = key.fileobj
+                    peer, pipe_r, pipe_w = key.data
+
+                    try:
+                        # 第一段splice：socket -> pipe（数据留在内核）
+                        n = os.splice(
+                            sock.fileno(), pipe_w, SPLICE_MAX, flags=splice_flags
+                        )
+                    except BlockingIOError:
+                        # selector偶尔会有虚假唤醒，继续等待即可
+                        continue
+                    except OSError as e:
+                        if (
+                            e.errno == errno.EINVAL
+                            and client_bytes == 0
+                            and server_bytes == 0
+                        ):
+                            # 内核不支持对这类fd做splice，回退到recv/send
+                            handled = False
+                            return False
+                        logger.error("数据转发错误: %s", e)
+                        return True
+
+                    if n == 0:
+                        if sock is client_socket:
+                            logger.debug("客户端关闭了连接")
+                        else:
+                            logger.debug("目标服务器关闭了连接")
+                        return True
+
+                    # 第二段splice：pipe -> 对端socket
+                    try:
+                        self._splice_pipe_to_socket(pipe_r, peer, n)
+                    except (OSError, ConnectionError) as e:
+                        logger.error("数据转发错误: %s", e)
+                        return True
+
+                    if sock is client_socket:
+                        client_bytes += n
+                    else:
+                        server_bytes += n
+
+        except KeyboardInterrupt:
+            logger.debug("用户中断，关闭隧道")
+            return True
+        except Exception as e:
+            logger.error("隧道转发异常: %s", e)
+            return True
+        finally:
+            sel.close()
+            for fd in (c2t_r, c2t_w, t2c_r, t2c_w):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            if handled:
+                try:
+                    client_socket.close()
+                    target_socket.close()
+                    logger.info(
+                        "HTTPS隧道已关闭 (%s:%s, 上行 %d 字节, 下行 %d 字节)",
+                        host, port, client_bytes, server_bytes,
+                    )
+                except:
+                    pass
+
+    @staticmethod
+    def _splice_pipe_to_socket(
+        pipe_r: int, dst_socket: socket.socket, count: int
+    ) -> None:
+        """
+        把pipe中的count字节splice到目标socket
+
+        目标socket的发送缓冲区可能已满（splice会抛BlockingIOError），
+        此时等待socket可写后继续，直到count字节全部送出。
+
+        Args:
+            pipe_r: pipe的读端fd
+            dst_socket: 目标socket
+            count: 需要转发的字节数
+        """
+        while count > 0:
+            try:
+                sent = os.splice(
+                    pipe_r, dst_socket.fileno(), count, flags=os.SPLICE_F_MOVE
                 )
+            except BlockingIOError:
+                # 发送缓冲区满，等待对端可写
+                wsel = selectors.DefaultSelector()
+                wsel.register(dst_socket, selectors.EVENT_WRITE)
+                ready = wsel.select(timeout=30)
+                wsel.close()
+                # 30秒仍不可写说明对端已卡死（客户端不再读数据），
+                # 和recv/send路径的空闲超时一样放弃隧道，
+                # 否则转发线程和两端socket、pipe fd会永久泄漏
+                if not ready:
+                    raise ConnectionError("对端30秒内不可写，放弃转发")
+                continue
+
+            if sent == 0:
+                raise ConnectionError("对端连接已关闭")
+            count -= sent
+
+    def _relay_data_select(
+        self,
+        client_socket: socket.socket,
+        target_socket: socket.socket,
+        host: str,
+        port: int,
+    ) -> None:
+        """
+        使用recv/send在用户态双向转发数据（通用回退路径）
+
+        Args:
+            client_socket: 与客户端的socket连接
+            target_socket: 与目标服务器的socket连接
+            host: 目标主机（用于日志）
+            port: 目标端口（用于日志）
+        """
+        logger.debug("开始HTTPS隧道数据转发 (%s:%s)", host, port)
+
+        # 创建selector进行多路复用
+        # selectors.DefaultSelector会自动选择当前平台上最高效的机制
+        # （Linux上是epoll，macOS/BSD上是kqueue），只注册关心的读事件，
+        # 避免select.select每次迭代都要拷贝和扫描三组fd集合
+        sel = selectors.DefaultSelector()
+
+        try:
+            # 设置socket为非阻塞模式，配合selector进行事件驱动的转发
+            client_socket.setblocking(False)
+            target_socket.setblocking(False)
 
-                # 处理异常
-                if exceptional:
-                    print(f"  [ERROR] 隧道异常，关闭连接")
-                    break
+            # 数据缓冲区大小
+            # 64KB可以让一次recv尽量取空TCP接收窗口，减少系统调用次数
+            BUFFER_SIZE = 65536
+
+            # 整条隧道复用同一块预分配缓冲区：recv_into直接往里写，
+            # 避免每次recv都分配一个新的bytes对象再丢给GC；
+            # memoryview切片让sendall只发实际收到的字节而不做拷贝
+            buf = bytearray(BUFFER_SIZE)
+            view = memoryview(buf)
+
+            # 统计转发的字节数，隧道关闭时一次性打印
+            # 每个4KB数据块都print一行会抢占stdout锁并产生一次write系统调用，
+            # 在大流量隧道上反而成为CPU瓶颈
+            client_bytes = 0  # 客户端 -> 目标服务器
+            server_bytes = 0  # 目标服务器 -> 客户端
+
+            # 注册两个socket的读事件，data字段保存"对端"socket，
+            # 这样事件回调时可以直接拿到要转发的目标
+            sel.register(client_socket, selectors.EVENT_READ, target_socket)
+            sel.register(target_socket, selectors.EVENT_READ, client_socket)
+
+            # 事件循环：等待任一socket可读，把数据转发到对端
+            while True:
+                events = sel.select(timeout=30)
+
+                # 超时没有任何数据，认为隧道已空闲，关闭连接
+                if not events:
+                    logger.debug("隧道空闲超时，关闭连接")
+                    return
 
-                # 处理可读的socket（有数据到达）
-                for sock in readable:
+                for key, _ in events:
+                    sock = key.fileobj
+                    peer = key.data
                     try:
-                        if sock == client_socket:
-                            # 从客户端读取数据，转发到目标服务器
-                            data = client_socket.recv(BUFFER_SIZE)
-                            if not data:
-                                print(f"  [SEND] 客户端关闭了连接")
-                                return
-
-                            # 直接转发到目标服务器（不解密HTTPS内容）
-                            target_socket.send(data)
-                            print(f"  [SEND] 转发客户端数据: {len(data)} 字节")
-
-                        elif sock == target_socket:
-                            # 从目标服务器读取数据，转发到客户端
-                            data = target_socket.recv(BUFFER_SIZE)
-                            if not data:
-                                print(f"  [SEND] 目标服务器关闭了连接")
-                                return
-
-                            # 直接转发到客户端（不解密HTTPS内容）
-                            client_socket.send(data)
-                            print(f"  [RECV] 转发服务器数据: {len(data)} 字节")
+                        # 从可读端读取数据到复用缓冲区（不解密HTTPS内容）
+                        nbytes = sock.recv_into(buf)
+                        if not nbytes:
+                            if sock is client_socket:
+                                logger.debug("客户端关闭了连接")
+                            else:
+                                logger.debug("目标服务器关闭了连接")
+                            return
+
+                        # 直接转发到对端（sendall保证整块数据发完）
+                        peer.sendall(view[:nbytes])
+                        if sock is client_socket:
+                            client_bytes += nbytes
+                        else:
+                            server_bytes += nbytes
 
                     except socket.error as e:
-                        print(f"  [ERROR] 数据转发错误: {e}")
+                        logger.error("数据转发错误: %s", e)
                         return
                     except Exception as e:
-                        print(f"  [ERROR] 转发异常: {e}")
+                        logger.error("转发异常: %s", e)
                         return
 
-                # 如果没有数据可读，检查连接是否还活跃
-                if not readable:
-                    # 可以在这里添加心跳检测等逻辑
-                    pass
-
         except KeyboardInterrupt:
-            print(f"  [SEND] 用户中断，关闭隧道")
+            logger.debug("用户中断，关闭隧道")
         except Exception as e:
-            print(f"  [ERROR] 隧道转发异常: {e}")
+            logger.error("隧道转发异常: %s", e)
         finally:
-            # 关闭所有连接
+            # 关闭selector和所有连接
+            sel.close()
             try:
                 client_socket.close()
                 target_socket.close()
-                print(f"  [OK] HTTPS隧道已关闭 ({host}:{port})")
+                logger.info(
+                    "HTTPS隧道已关闭 (%s:%s, 上行 %d 字节, 下行 %d 字节)",
+                    host, port, client_bytes, server_bytes,
+                )
             except:
                 pass
@@ -1,5 +1,6 @@
 """请求解析模块"""
 
+from .headers import CaseInsensitiveHeaders
 from .request_parser import RequestParser
 
-__all__ = ["RequestParser"]
+__all__ = ["CaseInsensitiveHeaders", "RequestParser"]
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+大小写不敏感的HTTP头部容器
+
+HTTP头部名是大小写不敏感的（RFC 7230），客户端发送 connection: 小写时，
+普通dict的 headers.pop("Connection") 会查不到。这个容器保留头部的
+原始大小写（转发和日志时原样输出），但查找、删除都按小写键匹配，
+每个键的.lower()只计算一次。
+"""
+
+
+class CaseInsensitiveHeaders(dict):
+    """大小写不敏感的HTTP头部字典
+
+    继承dict，因此可以直接被json序列化、被requests库当作头部映射使用。
+    内部额外维护一个 小写键 -> 原始键 的索引用于大小写不敏感查找。
+    """
+
+    def __init__(self, data=None):
+        super().__init__()
+        self._lower = {}  # 小写键 -> 实际存储的原始键
+        if data:
+            for key, value in dict(data).items():
+                self[key] = value
+
+    def __setitem__(self, key, value):
+        lower_key = key.lower()
+        # 同名头部（大小写不同）覆盖时，先移除旧的原始键
+        old_key = self._lower.get(lower_key)
+        if old_key is not None and old_key != key:
+            super().__delitem__(old_key)
+        self._lower[lower_key] = key
+        super().__setitem__(key, value)
+
+    def __getitem__(self, key):
+        actual_key = self._lower.get(key.lower())
+        if actual_key is None:
+            raise KeyError(key)
+        return super().__getitem__(actual_key)
+
+    def __delitem__(self, key):
+        actual_key = self._lower.pop(key.lower(), None)
+        if actual_key is None:
+            raise KeyError(key)
+        super().__delitem__(actual_key)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and key.lower() in self._lower
+
+    def get(self, key, default=None):
+        actual_key = self._lower.get(key.lower())
+        if actual_key is None:
+            return default
+        return super().__getitem__(actual_key)
+
+    def pop(self, key, *default):
+        actual_key = self._lower.pop(key.lower(), None)
+        if actual_key is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return super().pop(actual_key)
@@ -4,10 +4,52 @@
 HTTP请求解析器
 
 负责解析HTTP请求的各个组成部分，包括请求行、头部和请求体。
+解析直接在bytes上进行：只有请求行和头部会被解码成字符串，
+请求体保持原始bytes，避免对大body做无谓的UTF-8解码和拷贝。
+
+安装了httptools（uvloop使用的llhttp C解析器绑定）时，请求行和
+头部交给C状态机解析；否则使用纯Python实现，行为完全一致。
 """
 
+import logging
+import re
 from urllib.parse import urlparse
 
+from .headers import CaseInsensitiveHeaders
+
+logger = logging.getLogger(__name__)
+
+# 纯Python解析路径用的预编译bytes正则：
+# 请求行和所有头部各用一次C级正则扫描提取，
+# 替代逐行split/strip产生的O(头部数)个中间字符串
+_REQLINE_RE = re.compile(rb"([!#$%&'*+\-.^_`|~0-9A-Za-z]+) ([^ \r\n]+) (HTTP/\d\.\d)")
+_HEADER_RE = re.compile(rb"([!-9;-~]+):[ \t]*([^\r\n]*?)[ \t]*(?:\r\n|$)")
+
+# 统计Content-Length头部出现次数用（严格校验时检测重复声明）
+_CONTENT_LENGTH_LINE_RE = re.compile(rb"(?im)^content-length[ \t]*:")
+
+# 可选的C解析器：不在项目依赖中，安装了就自动启用
+try:
+    import httptools
+except ImportError:
+    httptools = None
+
+
+class _HeaderCollector:
+    """httptools解析回调的收集器，只收集URL和头部"""
+
+    __slots__ = ("url", "headers")
+
+    def __init__(self):
+        self.url = b""
+        self.headers = CaseInsensitiveHeaders()
+
+    def on_url(self, url: bytes) -> None:
+        self.url += url
+
+    def on_header(self, name: bytes, value: bytes) -> None:
+        self.headers[name.decode("latin-1")] = value.decode("latin-1").strip()
+
 
 class RequestParser:
     """HTTP请求解析器"""
@@ -31,84 +73,230 @@ class RequestParser:
             dict: 解析后的请求信息字典，包含：
                 - method: 请求方法（GET, POST等）
                 - url: 请求URL
-                - target_host: 目标主机（从Host头部获取）
+                - target_host: 目标主机（从Host头部获取；CONNECT请求为隧道目标主机）
+                - target_port: 目标端口（仅CONNECT请求）
                 - path: URL路径
                 - query: URL查询参数
                 - http_version: HTTP协议版本
                 - headers: 请求头部字典
-                - body: 请求体
-                - raw_request: 原始请求字符串
+                - body: 请求体（bytes，不做解码）
         """
         if not request_data:
             return {}
 
         try:
-            # 将bytes转换为字符串
-            request_str = request_data.decode("utf-8", errors="ignore")
-
-            # 按\r\n分割成行
-            lines = request_str.split("\r\n")
-
-            if not lines:
+            # 1. 定位头部结束位置（\r\n\r\n）
+            # 只对头部部分做解码，body保持bytes原样
+            header_end = request_data.find(b"\r\n\r\n")
+            if header_end < 0:
+                logger.debug("无效的请求：缺少头部结束标记")
                 return {}
 
-            # 1. 解析请求行（第一行）
-            # 格式：METHOD URL HTTP/VERSION
-            # 例如：GET /index.html?param=value HTTP/1.1
-            request_line = lines[0]
-            parts = request_line.split(" ", 2)  # 最多分割成3部分
+            header_block = request_data[:header_end]
 
-            if len(parts) < 3:
-                print(f"无效的请求行: {request_line}")
+            # 2. 严格校验头部结构
+            # 行分隔必须是完整的CRLF、Content-Length不允许重复——
+            # 裸CR/裸LF和多个Content-Length会让代理和目标服务器
+            # 对请求边界产生分歧，是典型的请求走私（smuggling）入口
+            if not RequestParser._headers_strictly_valid(header_block):
+                logger.debug("无效的请求：头部行结构不合法")
                 return {}
 
-            method = parts[0]  # GET, POST, PUT等
-            url = parts[1]  # /index.html?param=value
-            http_version = parts[2]  # HTTP/1.1
+            # 3. 解析请求行和头部
+            # 优先用httptools的C状态机；没装则走纯Python实现
+            if httptools is not None:
+                parsed_head = RequestParser._parse_head_httptools(
+                    request_data[: header_end + 4]
+                )
+            else:
+                parsed_head = RequestParser._parse_head_python(header_block)
 
-            # 2. 解析请求头部
-            # 头部从第二行开始，直到遇到空行
-            headers = {}
-            body_start_index = 0
+            if parsed_head is None:
+                return {}
 
-            for i, line in enumerate(lines[1:], start=1):
-                if not line.strip():  # 空行表示头部结束
-                    body_start_index = i + 1
-                    break
+            method, url, http_version, headers = parsed_head
 
-                # 头部格式：Key: Value
-                if ":" in line:
-                    key, value = line.split(":", 1)  # 只分割第一个冒号
-                    headers[key.strip()] = value.strip()
+            # 4. 请求体保持原始bytes（不解码、不重新拼接）
+            body = request_data[header_end + 4 :]
 
-            # 3. 解析请求体（如果有）
-            body = ""
-            if body_start_index < len(lines):
-                body = "\r\n".join(lines[body_start_index:])
+            # 5. CONNECT请求单独处理
+            # CONNECT的URL是 host:port 而不是真正的URL，交给urlparse
+            # 会被当成路径解析；这里直接解析出主机和端口，
+            # 处理器就不需要再做一次字符串拆分
+            if method == "CONNECT":
+                target_host, target_port = RequestParser._parse_connect_target(url)
+                return {
+                    "method": method,
+                    "url": url,
+                    "target_host": target_host,
+                    "target_port": target_port,
+                    "path": "",
+                    "query": "",
+                    "http_version": http_version,
+                    "headers": headers,
+                    "body": body,
+                }
 
-            # 4. 解析URL
-            # 使用urlparse解析URL，提取路径和查询参数
-            parsed_url = urlparse(url)
+            # 6. 解析URL
+            # 常见的origin-form（/path?query）一次partition就能拆开，
+            # 不需要urlparse的完整解析逻辑（正则、SplitResult、
+            # scheme/netloc处理）；绝对URL才走urlparse
+            if url.startswith("/"):
+                path, _, query = url.partition("?")
+                netloc = ""
+            else:
+                parsed_url = urlparse(url)
+                path = parsed_url.path
+                query = parsed_url.query
+                netloc = parsed_url.netloc
 
-            # 5. 获取目标主机
+            # 7. 获取目标主机
             # 优先从Host头部获取，如果没有则从URL中提取
             target_host = headers.get("Host", "")
-            if not target_host and parsed_url.netloc:
-                target_host = parsed_url.netloc
+            if not target_host and netloc:
+                target_host = netloc
 
             # 返回解析结果
             return {
                 "method": method,
                 "url": url,
                 "target_host": target_host,
-                "path": parsed_url.path or "/",
-                "query": parsed_url.query,
+                "path": path or "/",
+                "query": query,
                 "http_version": http_version,
                 "headers": headers,
                 "body": body,
-                "raw_request": request_str,  # 保留原始请求字符串，方便调试
             }
 
         except Exception as e:
-            print(f"解析请求时出错: {e}")
+            logger.error("解析请求时出错: %s", e)
             return {}
+
+    @staticmethod
+    def _headers_strictly_valid(header_block: bytes) -> bool:
+        """
+        严格校验头部块的行结构（RFC 7230，防御请求走私）
+
+        - 行分隔符必须是完整的\r\n：行内出现裸CR或裸LF时，
+          不同实现对"一行"的理解会不一致，请求边界随之失步
+        - Content-Length最多出现一次：重复声明时前后端可能各取一个
+
+        三次C级count加一次正则扫描，合法头部不产生任何中间对象。
+
+        Args:
+            header_block: 不含\r\n\r\n结束标记的头部字节块
+
+        Returns:
+            bool: True表示头部行结构合法
+        """
+        # 所有CR和LF必须成对出现为CRLF：
+        # 任一单独出现都会使count(b"\r")或count(b"\n")多于count(b"\r\n")
+        crlf_count = header_block.count(b"\r\n")
+        if (
+            header_block.count(b"\r") != crlf_count
+            or header_block.count(b"\n") != crlf_count
+        ):
+            return False
+
+        # Content-Length出现多于一次即拒绝
+        if len(_CONTENT_LENGTH_LINE_RE.findall(header_block)) > 1:
+            return False
+
+        return True
+
+    @staticmethod
+    def _parse_head_python(header_block: bytes):
+        """
+        纯Python解析请求行和头部
+
+        Args:
+            header_block: 不含\r\n\r\n结束标记的头部字节块
+
+        Returns:
+            (method, url, http_version, headers)元组；解析失败返回None
+        """
+        # 解析请求行
+        # 格式：METHOD URL HTTP/VERSION
+        # 例如：GET /index.html?param=value HTTP/1.1
+        m = _REQLINE_RE.match(header_block)
+        if m is None:
+            request_line = header_block.split(b"\r\n", 1)[0]
+            logger.debug("无效的请求行: %r", request_line)
+            return None
+
+        # 请求行只包含ASCII字符，用latin-1解码不会失败
+        method = m.group(1).decode("latin-1")  # GET, POST等
+        url = m.group(2).decode("latin-1")  # /index.html?param=value
+        http_version = m.group(3).decode("latin-1")  # HTTP/1.1
+
+        # 解析请求头部
+        # 一次findall提取全部 Key: Value 对（正则顺带吃掉两侧空白），
+        # 不再逐行split/strip；头部名大小写不敏感，用专门的容器存储
+        headers = CaseInsensitiveHeaders()
+        for key, value in _HEADER_RE.findall(header_block, m.end()):
+            headers[key.decode("latin-1")] = value.decode("latin-1")
+
+        return method, url, http_version, headers
+
+    @staticmethod
+    def _parse_head_httptools(head_data: bytes):
+        """
+        使用httptools（llhttp的C绑定）解析请求行和头部
+
+        只喂入头部部分（含\r\n\r\n结束标记），body由调用方
+        自己切片，避免C解析器继续解析body或pipeline中的下一个请求。
+
+        Args:
+            head_data: 含\r\n\r\n结束标记的头部字节块
+
+        Returns:
+            (method, url, http_version, headers)元组；解析失败返回None
+        """
+        collector = _HeaderCollector()
+        parser = httptools.HttpRequestParser(collector)
+
+        try:
+            parser.feed_data(head_data)
+        except httptools.HttpParserUpgrade:
+            # CONNECT/Upgrade请求会抛这个异常，此时头部已解析完成
+            pass
+        except httptools.HttpParserError as e:
+            logger.debug("无效的请求: %s", e)
+            return None
+
+        method_bytes = parser.get_method()
+        if method_bytes is None:
+            return None
+
+        method = method_bytes.decode("latin-1")
+        url = collector.url.decode("latin-1")
+        http_version = f"HTTP/{parser.get_http_version()}"
+
+        return method, url, http_version, collector.headers
+
+    @staticmethod
+    def _parse_connect_target(url: str) -> tuple:
+        """
+        解析CONNECT请求的目标 host:port
+
+        使用rpartition从右侧找冒号，这样IPv6字面量（如 [::1]:443）中
+        的冒号不会被误当作端口分隔符；没有端口时使用HTTPS默认的443。
+
+        Args:
+            url: CONNECT请求行中的目标，如 www.example.com:443
+
+        Returns:
+            tuple: (host, port)
+        """
+        host, sep, port_str = url.rpartition(":")
+        if sep and port_str.isdigit():
+            port = int(port_str)
+        else:
+            host = url
+            port = 443  # HTTPS默认端口
+
+        # 去掉IPv6字面量外层的方括号
+        if host.startswith("[") and host.endswith("]"):
+            host = host[1:-1]
+
+        return host, port
@@ -10,7 +10,12 @@ HTTP代理服务器 - 重构版本
     uv sync
 """
 
+import logging
+import multiprocessing
+import re
+import selectors
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Tuple
 
 from parsers.request_parser import RequestParser
@@ -19,11 +24,24 @@ from handlers.http_handler import HTTPHandler
 from handlers.https_handler import HTTPSHandler
 from builders.response_builder import ResponseBuilder
 
+logger = logging.getLogger(__name__)
+
+# 在头部字节块中定位Content-Length的预编译正则：
+# 一次C级扫描代替split出整个行列表再逐行比较前缀
+_CONTENT_LENGTH_RE = re.compile(rb"(?im)^content-length:[ \t]*(\d+)[ \t]*\r?$")
+
 
 class ProxyServer:
     """代理服务器主类"""
 
-    def __init__(self, host="127.0.0.1", port=8888, log_file="proxy_log.json"):
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=8888,
+        log_file="proxy_log.jsonl",
+        workers=1,
+        verbose=False,
+    ):
         """
         初始化代理服务器
 
@@ -31,10 +49,23 @@ class ProxyServer:
             host: 监听地址（127.0.0.1表示只监听本地，0.0.0.0表示监听所有网络接口）
             port: 监听端口
             log_file: 日志文件路径，用于保存所有请求记录
+            workers: 工作进程数。大于1时派生额外进程，各自监听同一端口
+                （SO_REUSEPORT），由内核把新连接分摊到各进程，
+                让解析等CPU密集路径用上多个核心
+            verbose: 是否在stdout上打印每个请求的详细信息。
+                print要抢stdio锁并触发write系统调用，高负载下会把
+                整个服务器串行化，默认关闭；学习/调试时打开
         """
         self.host = host
         self.port = port
         self.socket = None
+        self.workers = workers
+        self.worker_processes = []
+        self.verbose = verbose
+
+        # 处理客户端连接的工作线程池（在start()中创建）
+        # 解析和转发都在工作线程上进行，accept循环只负责接受连接
+        self.worker_pool = None
 
         # 初始化各个模块
         self.request_parser = RequestParser()
@@ -45,6 +76,26 @@ class ProxyServer:
 
     def start(self):
         """启动代理服务器"""
+        # 多进程模式：先派生workers-1个子进程，每个子进程（以及主进程）
+        # 都各自创建监听socket并bind到同一端口，SO_REUSEPORT让内核
+        # 把新连接负载均衡到各个进程的accept队列
+        #
+        # 显式要求fork启动方式：默认的forkserver/spawn要把self整个
+        # pickle过去，而日志记录器里有打开的文件句柄、写线程和锁，
+        # 根本不可pickle。整个设计（子进程继承已初始化的服务器、
+        # 日志写线程按pid检测重建）假设的就是fork语义
+        ctx = multiprocessing.get_context("fork")
+        for i in range(self.workers - 1):
+            p = ctx.Process(
+                target=self._run, name=f"proxy-worker-{i + 1}", daemon=True
+            )
+            p.start()
+            self.worker_processes.append(p)
+
+        self._run()
+
+    def _run(self):
+        """创建监听socket并运行accept循环（每个工作进程各执行一份）"""
         # 创建一个TCP socket
         # AF_INET 表示使用IPv4
         # SOCK_STREAM 表示使用TCP协议
@@ -53,15 +104,33 @@ class ProxyServer:
         # 设置socket选项，允许地址重用（这样即使端口被占用，重启后也能立即使用）
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        # 多个进程同时bind同一端口需要SO_REUSEPORT（Linux 3.9+/BSD）；
+        # 单进程模式下设置它也无害
+        if hasattr(socket, "SO_REUSEPORT"):
+            try:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            except OSError:
+                pass
+
         # 绑定到指定的地址和端口
         self.socket.bind((self.host, self.port))
 
         # 开始监听，参数10表示最多允许10个连接在队列中等待
         self.socket.listen(10)
 
-        # 设置socket超时，这样accept()会定期返回，可以检查KeyboardInterrupt
-        # 在Windows上，阻塞的socket操作可能不会立即响应Ctrl-C
-        self.socket.settimeout(1.0)  # 1秒超时
+        # 用selectors等待新连接：select没有超时参数时一直阻塞，
+        # 收到信号（Ctrl-C）会被EINTR唤醒并抛出KeyboardInterrupt，
+        # 不再需要以前那种每秒醒一次检查中断的1秒超时轮询
+        self.socket.setblocking(False)
+        accept_sel = selectors.DefaultSelector()
+        accept_sel.register(self.socket, selectors.EVENT_READ)
+
+        # 创建处理客户端连接的线程池
+        # 每个连接的接收/解析/转发都提交到线程池，accept循环立即回去
+        # 接受下一个连接，慢客户端或慢目标服务器不再阻塞其他客户端
+        self.worker_pool = ThreadPoolExecutor(
+            max_workers=64, thread_name_prefix="client"
+        )
 
         print(f"代理服务器启动在 {self.host}:{self.port}")
         print(f"等待客户端连接...")
@@ -70,75 +139,35 @@ class ProxyServer:
         try:
             # 无限循环，持续接受客户端连接
             while True:
+                # 阻塞等待监听socket可读（即有新连接到达）
+                accept_sel.select()
+
                 try:
-                    # accept() 会阻塞等待，直到有客户端连接或超时
                     # client_socket: 与客户端通信的socket对象
                     # client_address: 客户端的地址元组 (IP, 端口)
+                    # 注意：非阻塞监听socket上accept出的新socket
+                    # 仍是阻塞模式，后续收发逻辑不受影响
                     client_socket, client_address = self.socket.accept()
-                except socket.timeout:
-                    # 超时是正常的，继续循环以检查KeyboardInterrupt
+                except BlockingIOError:
+                    # 连接在select和accept之间被客户端撤回（RST），继续等待
                     continue
 
-                print(f"收到来自 {client_address[0]}:{client_address[1]} 的连接")
+                if self.verbose:
+                    print(f"收到来自 {client_address[0]}:{client_address[1]} 的连接")
 
+                # 禁用Nagle算法：响应头部单独sendall时不会被内核
+                # 攒着等body，客户端能立即收到第一个字节
                 try:
-                    # 接收完整的HTTP请求
-                    request_data = self._receive_full_request(client_socket)
-
-                    if request_data:
-                        # 解析HTTP请求
-                        request_info = self.request_parser.parse(request_data)
-
-                        if request_info:
-                            # 打印解析结果
-                            self._print_request_info(request_info)
-
-                            # 将请求记录到JSON文件
-                            self.logger.log(request_info, client_address)
-
-                            # 根据请求方法选择处理器
-                            method = request_info.get("method", "").upper()
-
-                            if method == "CONNECT":
-                                # HTTPS请求：使用HTTPS处理器
-                                response_data = self.https_handler.handle(
-                                    request_info, client_socket
-                                )
-                                # CONNECT请求已完全处理（包括数据转发），不需要继续
-                                if response_data is not None:
-                                    # 如果返回了错误响应，发送给客户端
-                                    self._send_response(client_socket, response_data)
-                            else:
-                                # HTTP请求：使用HTTP处理器
-                                response_data = self.http_handler.handle(request_info)
-
-                                # 将响应发送回客户端
-                                if response_data:
-                                    self._send_response(client_socket, response_data)
-                                else:
-                                    print("[ERROR] 未能获取响应")
-                        else:
-                            print("无法解析请求")
-                            # 发送错误响应
-                            error_response = self.response_builder.create_error_response(
-                                400, "Bad Request: Unable to parse request"
-                            )
-                            self._send_response(client_socket, error_response)
-                    else:
-                        print("未收到请求数据")
+                    client_socket.setsockopt(
+                        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+                    )
+                except OSError:
+                    pass
 
-                except Exception as e:
-                    print(f"处理请求时出错: {e}")
-                finally:
-                    # 关闭客户端连接
-                    # 注意：对于HTTP/1.1，如果响应头部有Connection: close，应该关闭连接
-                    # 对于HTTP/1.0，默认关闭连接
-                    # 对于CONNECT请求，连接已在处理器中关闭
-                    try:
-                        client_socket.close()
-                    except:
-                        pass
-                    print(f"已关闭与 {client_address} 的连接\n")
+                # 把整个连接的处理交给工作线程，accept循环继续
+                self.worker_pool.submit(
+                    self._serve_client, client_socket, client_address
+                )
 
         except KeyboardInterrupt:
             print("\n正在关闭服务器...")
@@ -147,15 +176,170 @@ class ProxyServer:
             print(f"\n服务器出错: {e}")
             self.stop()
 
+    def _serve_client(
+        self, client_socket: socket.socket, client_address: Tuple[str, int]
+    ) -> None:
+        """
+        处理单个客户端连接（在工作线程中运行）
+
+        Args:
+            client_socket: 与客户端的socket连接
+            client_address: 客户端的地址元组 (IP, 端口)
+        """
+        # CONNECT隧道建立后由独立的转发线程接管client_socket，
+        # 此时工作线程不能再关闭这个socket
+        socket_detached = False
+
+        try:
+            # keep-alive循环：同一个客户端连接上依次处理多个请求，
+            # 直到客户端要求关闭（Connection: close / HTTP/1.0）、
+            # 发生错误或空闲超时。省掉每个请求一次TCP握手
+            is_first_request = True
+
+            # 管线化客户端一次可能发来多个请求，多收的字节暂存在这里，
+            # 作为下一轮接收的起点，保证请求按序逐个处理
+            leftover = b""
+
+            while True:
+                # 首个请求给30秒，后续请求之间给15秒空闲超时
+                request_data, leftover = self._receive_full_request(
+                    client_socket,
+                    timeout=30 if is_first_request else 15,
+                    initial=leftover,
+                )
+
+                if not request_data:
+                    if is_first_request and self.verbose:
+                        print("未收到请求数据")
+                    # 客户端关闭连接或空闲超时，结束keep-alive循环
+                    break
+
+                # 解析HTTP请求
+                request_info = self.request_parser.parse(request_data)
+
+                if not request_info:
+                    if self.verbose:
+                        print("无法解析请求")
+                    # 发送错误响应（错误响应都带Connection: close）
+                    error_response = self.response_builder.create_error_response(
+                        400, "Bad Request: Unable to parse request"
+                    )
+                    self._send_response(client_socket, error_response)
+                    break
+
+                # 打印解析结果
+                self._print_request_info(request_info)
+
+                # 将请求记录到JSON文件
+                self.logger.log(request_info, client_address)
+
+                # 根据请求方法选择处理器
+                method = request_info.get("method", "").upper()
+
+                if method == "CONNECT":
+                    # HTTPS请求：使用HTTPS处理器
+                    response_data = self.https_handler.handle(
+                        request_info, client_socket
+                    )
+                    # 隧道建立成功时数据转发在独立线程中继续进行
+                    if response_data is not None:
+                        # 如果返回了错误响应，发送给客户端
+                        self._send_response(client_socket, response_data)
+                    else:
+                        socket_detached = request_info.get(
+                            "tunnel_detached", False
+                        )
+                    # 无论成败，CONNECT之后这个socket都不再承载HTTP请求
+                    break
+
+                # HTTP请求：使用HTTP处理器
+                # 正常情况下响应已直接流式写入client_socket，
+                # 返回bytes说明出错了，需要发送错误响应
+                response_data = self.http_handler.handle(
+                    request_info, client_socket
+                )
+                if response_data:
+                    self._send_response(client_socket, response_data)
+                    # 错误响应都以Connection: close结尾
+                    break
+
+                # 响应没有Content-Length时以关闭连接定界，必须关闭
+                if request_info.get("connection_close"):
+                    break
+
+                # 客户端侧的连接语义：显式close或HTTP/1.0未请求保活时关闭
+                if not self._keep_alive_requested(request_info):
+                    break
+
+                is_first_request = False
+
+        except Exception as e:
+            print(f"处理请求时出错: {e}")
+        finally:
+            # 关闭客户端连接
+            # 注意：对于HTTP/1.1，如果响应头部有Connection: close，应该关闭连接
+            # 对于HTTP/1.0，默认关闭连接
+            # 对于已转交转发线程的CONNECT隧道，socket由转发线程负责关闭
+            if socket_detached:
+                if self.verbose:
+                    print(f"隧道已转交转发线程处理 ({client_address})\n")
+            else:
+                try:
+                    client_socket.close()
+                except:
+                    pass
+                if self.verbose:
+                    print(f"已关闭与 {client_address} 的连接\n")
+
+    @staticmethod
+    def _keep_alive_requested(request_info: dict) -> bool:
+        """
+        根据请求判断客户端连接是否保持
+
+        HTTP/1.1默认keep-alive，除非显式Connection: close；
+        HTTP/1.0默认关闭，除非显式Connection: keep-alive。
+
+        Args:
+            request_info: 解析后的请求信息字典
+
+        Returns:
+            bool: True表示连接应保持，继续接收下一个请求
+        """
+        connection = str(
+            request_info.get("headers", {}).get("Connection", "")
+        ).lower()
+        if "close" in connection:
+            return False
+        if request_info.get("http_version") == "HTTP/1.0":
+            return "keep-alive" in connection
+        return True
+
     def stop(self):
         """停止代理服务器"""
+        for p in self.worker_processes:
+            if p.is_alive():
+                p.terminate()
+        self.worker_processes = []
+        if self.worker_pool:
+            # 不等待仍在处理中的连接，工作线程随进程退出
+            self.worker_pool.shutdown(wait=False)
+            self.worker_pool = None
+        # 释放HTTP转发Session连接池里缓存的上游连接
+        self.http_handler.close()
+        # 关闭日志文件
+        self.logger.close()
         if self.socket:
             self.socket.close()
             print("服务器已关闭")
 
-    def _receive_full_request(self, client_socket: socket.socket) -> bytes:
+    def _receive_full_request(
+        self,
+        client_socket: socket.socket,
+        timeout: float = 30,
+        initial: bytes = b"",
+    ) -> Tuple[bytes, bytes]:
         """
-        接收完整的HTTP请求
+        接收一个完整的HTTP请求
 
         HTTP请求格式：
         - 请求行（方法 URL 协议版本）
@@ -163,57 +347,102 @@ class ProxyServer:
         - 空行（\r\n\r\n）
         - 请求体（可选，如果有Content-Length头部）
 
+        管线化（pipelining）的客户端会把多个请求连续发出，一次recv
+        可能带上下一个请求的开头。这里只取出第一个完整请求，多收的
+        字节原样返回给调用方，由调用方作为下一次的initial传回来。
+
         Args:
             client_socket: 客户端socket连接
+            timeout: 接收超时秒数（keep-alive连接的后续请求用较短的空闲超时）
+            initial: 上一次多收的字节（属于本请求的开头）
 
         Returns:
-            bytes: 完整的请求数据
+            Tuple[bytes, bytes]: (本请求的完整数据, 多收的剩余字节)
         """
-        request_data = b""
-        client_socket.settimeout(30)  # 设置30秒超时
+        client_socket.settimeout(timeout)
+
+        # 预分配的接收缓冲区：recv_into直接把数据写进来，
+        # 替代 request_data += chunk 的写法——bytes拼接每次都要
+        # 重新分配并拷贝整个已收到的数据，大请求上是O(N²)的开销。
+        # 初始64KB与常见的SO_RCVBUF相当，一次recv就能取空接收窗口，
+        # 普通请求（头部+小body）一次系统调用即可收完
+        buf = bytearray(max(65536, len(initial)))
+        pos = len(initial)
+        if initial:
+            buf[: len(initial)] = initial
+        view = memoryview(buf)
+        header_end = -1  # \r\n\r\n的位置（找到后不再重复扫描头部）
+        content_length = 0
+
+        # 增量扫描起点：每轮只在新收到的字节（以及可能被上一轮
+        # 截断的结束标记的最后3字节）中找\r\n\r\n，而不是每次recv
+        # 都从头扫描整个缓冲区——大头部分多次到达时后者是O(N²)
+        scan_from = 0
 
         try:
-            # 循环接收数据，直到收到完整的请求
             while True:
-                chunk = client_socket.recv(4096)
-                if not chunk:
-                    break
-                request_data += chunk
-
-                # 检查是否已经收到请求头部（头部以\r\n\r\n结束）
-                if b"\r\n\r\n" in request_data:
-                    # 分离头部和body
-                    headers_end = request_data.find(b"\r\n\r\n")
-                    headers_data = request_data[:headers_end]
-
-                    # 尝试解析Content-Length头部
-                    headers_text = headers_data.decode("utf-8", errors="ignore")
-                    content_length = 0
-
-                    for line in headers_text.split("\r\n"):
-                        if line.lower().startswith("content-length:"):
-                            try:
-                                content_length = int(line.split(":", 1)[1].strip())
-                            except ValueError:
-                                pass
-                            break
-
-                    # 如果已经收到完整的请求（头部 + body），退出循环
-                    body_start = headers_end + 4  # +4 是 \r\n\r\n 的长度
-                    if len(request_data) >= body_start + content_length:
-                        break
-
-                    # 如果Content-Length为0，说明没有body，也可以退出
-                    if content_length == 0:
-                        break
-
-            return request_data
+                # 先检查已有数据是否构成完整请求：
+                # 管线化时initial可能已经是一个完整请求，无需再recv
+                if header_end < 0 and pos > 0:
+                    header_end = buf.find(b"\r\n\r\n", scan_from, pos)
+                    if header_end < 0:
+                        # 没找到：下一轮从当前末尾回退3字节开始，
+                        # 覆盖跨recv边界被拆开的\r\n\r\n
+                        scan_from = max(0, pos - 3)
+                    if header_end >= 0:
+                        # 头部收齐后在bytes上解析一次Content-Length，
+                        # 不再每收一块就整体解码头部
+                        content_length = self._parse_content_length(
+                            bytes(view[:header_end])
+                        )
+
+                if header_end >= 0:
+                    # +4 是 \r\n\r\n 的长度；
+                    # Content-Length为0（没有body）时立即成立
+                    request_end = header_end + 4 + content_length
+                    if pos >= request_end:
+                        return (
+                            bytes(view[:request_end]),
+                            bytes(view[request_end:pos]),
+                        )
+
+                # 缓冲区写满时翻倍扩容（摊还成本为常数）
+                # bytearray在有memoryview引用时不允许改变大小，
+                # 扩容前必须先释放旧视图
+                if pos == len(buf):
+                    view.release()
+                    buf.extend(b"\x00" * len(buf))
+                    view = memoryview(buf)
+
+                n = client_socket.recv_into(view[pos:])
+                if not n:
+                    # 对端关闭：把已收到的数据交给解析器判定
+                    return bytes(view[:pos]), b""
+                pos += n
+
         except socket.timeout:
-            print("接收请求超时")
-            return b""
+            # 每请求路径不走print（抢stdio锁会串行化服务器），
+            # 记debug日志，默认无输出
+            if pos:
+                logger.debug("接收请求超时（已收到 %d 字节）", pos)
+            return b"", b""
         except Exception as e:
-            print(f"接收请求时出错: {e}")
-            return b""
+            logger.error("接收请求时出错: %s", e)
+            return b"", b""
+
+    @staticmethod
+    def _parse_content_length(headers_data: bytes) -> int:
+        """
+        从头部字节块中解析Content-Length的值
+
+        Args:
+            headers_data: 不含\r\n\r\n结束标记的头部字节块
+
+        Returns:
+            int: Content-Length的值，没有该头部或值非法时返回0
+        """
+        m = _CONTENT_LENGTH_RE.search(headers_data)
+        return int(m.group(1)) if m else 0
 
     def _print_request_info(self, request_info: dict) -> None:
         """
@@ -222,6 +451,9 @@ class ProxyServer:
         Args:
             request_info: 解析后的请求信息字典
         """
+        if not self.verbose:
+            return
+
         print("\n" + "=" * 50)
         print("解析到的请求信息：")
         print(f"  方法: {request_info.get('method')}")
@@ -251,24 +483,29 @@ class ProxyServer:
             return
 
         try:
-            total_sent = 0
-            while total_sent < len(response_data):
-                sent = client_socket.send(response_data[total_sent:])
-                if sent == 0:
-                    raise RuntimeError("Socket connection broken")
-                total_sent += sent
-            print(f"[OK] 已转发响应给客户端 ({total_sent} 字节)")
+            # sendall在C层完成整个发送循环：不像手写的send循环那样
+            # 每次迭代都要为response_data[total_sent:]分配一个新切片
+            client_socket.sendall(response_data)
+            if self.verbose:
+                print(f"[OK] 已转发响应给客户端 ({len(response_data)} 字节)")
         except Exception as e:
-            print(f"[ERROR] 发送响应时出错: {e}")
+            # 客户端发完畸形请求就复位连接时，400还没发出去就会
+            # 在这里碰到EPIPE/ECONNRESET——同样是每连接一次的
+            # 攻击者可控路径，走logging而不是print
+            logger.error("发送响应时出错: %s", e)
 
 
 def main():
     """主函数"""
     # 创建代理服务器实例
-    # log_file参数指定日志文件路径，默认为 'proxy_log.json'
-    proxy = ProxyServer(host="127.0.0.1", port=8888, log_file="proxy_log.json")
-
-    print(f"日志将保存到: proxy_log.json")
+    # log_file参数指定日志文件路径，默认为 'proxy_log.jsonl'
+    # verbose=True在stdout打印每个请求，便于学习观察；
+    # 压测或生产环境应去掉该参数（默认False）
+    proxy = ProxyServer(
+        host="127.0.0.1", port=8888, log_file="proxy_log.jsonl", verbose=True
+    )
+
+    print(f"日志将保存到: proxy_log.jsonl")
     print()
 
     # 启动服务器
@@ -3,43 +3,108 @@
 """
 请求日志记录器
 
-负责将HTTP请求信息记录到JSON文件。
+负责将HTTP请求信息记录到JSON Lines文件（每行一个JSON对象）。
+写盘在后台线程中进行，请求路径上只做序列化和入队。
 """
 
+import hashlib
 import json
+import logging
+import os
+import queue
+import threading
+import time
 from datetime import datetime
 from typing import Dict, Tuple
 
+# 可选的C实现JSON编码器：不在项目依赖中，安装了就自动启用
+# （orjson比标准库json快数倍，且原生输出UTF-8）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# 写线程的关闭哨兵
+_CLOSE = object()
+
+# 写入日志的头部白名单：完整头部字典会把target_host/path等
+# 已单独记录的信息重复一遍，还带着Cookie、Accept-*这类对
+# 事后分析没用的长值。只记录定位一条请求所需的最小集合
+_LOGGED_HEADERS = frozenset({"host", "user-agent", "content-type"})
+
 
 class RequestLogger:
     """请求日志记录器"""
 
-    def __init__(self, log_file: str = "proxy_log.json"):
+    # 队列上限：写盘跟不上时宁可丢日志也不能让请求线程阻塞在磁盘上
+    QUEUE_MAXSIZE = 10000
+
+    def __init__(self, log_file: str = "proxy_log.jsonl"):
         """
         初始化日志记录器
 
+        日志文件在初始化时以追加模式打开一次，之后每条记录只需
+        一次write。旧实现每条记录都要读入整个JSON数组、追加、
+        再整体重写文件，日志越大每条记录的开销越高（O(N²)）；
+        JSON Lines格式让每条记录的成本恒定，文件也可以安全地
+        被多个进程以O_APPEND方式同时写入。
+
+        写盘由单独的守护线程完成：请求线程只把序列化好的行放进
+        有界队列就返回，磁盘延迟不再出现在请求的关键路径上。
+
         Args:
             log_file: 日志文件路径
         """
         self.log_file = log_file
+        self._log_fh = open(log_file, "a", encoding="utf-8")
+
+        self._queue = queue.Queue(maxsize=self.QUEUE_MAXSIZE)
+        self._dropped = 0
+
+        # 时间戳的"秒"部分缓存：datetime构造和isoformat格式化在
+        # 高负载下意外地热，同一秒内的请求只格式化一次秒级前缀，
+        # 每条记录只需补上微秒部分
+        self._ts_second = -1
+        self._ts_prefix = ""
+        self._writer = threading.Thread(
+            target=self._write_loop, name="log-writer", daemon=True
+        )
+        self._writer.start()
+
+        # 写线程所属的进程：线程不会跨fork存活，多进程模式
+        # （workers>1）下子进程发现pid不匹配时要重建自己的写线程
+        self._writer_pid = os.getpid()
+        self._fork_lock = threading.Lock()
 
     def log(self, request_info: Dict, client_address: Tuple[str, int]) -> None:
         """
-        将请求信息记录到JSON文件
-
-        这个方法会：
-        1. 读取现有的日志文件（如果存在）
-        2. 将新请求添加到日志列表
-        3. 保存回文件
+        将请求信息追加到JSON Lines文件
 
         Args:
             request_info: 解析后的请求信息字典
             client_address: 客户端地址元组 (IP, 端口)
         """
+        # 请求体不再全量入日志：MB级的上传body会让序列化和写盘
+        # 成为整个日志路径的瓶颈。只记录长度和SHA-256摘要的前16位
+        # （足以判断两次请求的body是否相同）；文本类型的body额外
+        # 保留前256个字符作为预览，便于肉眼排查
+        body = request_info.get("body", b"")
+        if not isinstance(body, (bytes, bytearray)):
+            body = str(body).encode("utf-8", errors="replace")
+        body_len = len(body)
+
+        # 头部只记录白名单里的几项，其余头部不进日志
+        headers = request_info.get("headers", {})
+        logged_headers = {
+            k: v for k, v in headers.items() if k.lower() in _LOGGED_HEADERS
+        }
+
         # 构建日志条目
         # 注意：我们只保存必要的信息，不保存原始请求字符串（可能很大）
         log_entry = {
-            "timestamp": datetime.now().isoformat(),  # ISO格式的时间戳
+            "timestamp": self._format_timestamp(),  # ISO格式的时间戳
             "client_address": f"{client_address[0]}:{client_address[1]}",  # 客户端IP:端口
             "method": request_info.get("method"),  # 请求方法
             "url": request_info.get("url"),  # 请求URL
@@ -47,11 +112,22 @@ class RequestLogger:
             "path": request_info.get("path"),  # URL路径
             "query": request_info.get("query"),  # 查询参数
             "http_version": request_info.get("http_version"),  # HTTP版本
-            "headers": request_info.get("headers", {}),  # 请求头部
-            "body": request_info.get("body", ""),  # 请求体
-            "body_length": len(request_info.get("body", "")),  # 请求体长度（字节）
+            "headers": logged_headers,  # 白名单头部
+            "body_length": body_len,  # 请求体长度（字节）
         }
 
+        if body_len:
+            log_entry["body_sha256"] = hashlib.sha256(
+                bytes(body)
+            ).hexdigest()[:16]
+            content_type = str(headers.get("Content-Type", "")).lower()
+            if content_type.startswith("text/") or content_type.startswith(
+                "application/json"
+            ):
+                log_entry["body_preview"] = bytes(body[:256]).decode(
+                    "utf-8", errors="replace"
+                )
+
         # 如果是CONNECT请求，添加额外信息
         if request_info.get("method") == "CONNECT":
             log_entry["tunnel_established"] = request_info.get(
@@ -59,34 +135,98 @@ class RequestLogger:
             )
 
         try:
-            # 读取现有的日志文件
-            # 如果文件不存在或格式错误，则创建一个空列表
+            # 单行紧凑JSON（无缩进、无多余空格），入队后由写线程落盘
+            # 优先用orjson（C实现）；没装则退回标准库json，输出等价
+            if orjson is not None:
+                line = orjson.dumps(log_entry).decode("utf-8")
+            else:
+                line = json.dumps(
+                    log_entry, ensure_ascii=False, separators=(",", ":")
+                )
+            # fork出的工作进程继承的是父进程写线程的"尸体"——
+            # 队列里的行没有任何线程在消费。发现写线程不属于
+            # 当前进程时，先在本进程重建队列和写线程
+            if self._writer_pid != os.getpid():
+                self._restart_writer_after_fork()
+
             try:
-                with open(self.log_file, "r", encoding="utf-8") as f:
-                    logs = json.load(f)
-                    # 确保logs是列表
-                    if not isinstance(logs, list):
-                        logs = []
-            except FileNotFoundError:
-                # 文件不存在，创建新列表
-                logs = []
-            except json.JSONDecodeError:
-                # JSON格式错误，创建新列表
-                print(f"警告：日志文件 {self.log_file} 格式错误，将创建新文件")
-                logs = []
-
-            # 添加新的日志条目
-            logs.append(log_entry)
-
-            # 将日志写回文件
-            # ensure_ascii=False: 允许中文字符正常显示
-            # indent=2: 格式化JSON，使其更易读
-            with open(self.log_file, "w", encoding="utf-8") as f:
-                json.dump(logs, f, ensure_ascii=False, indent=2)
-
-            print(
-                f"[OK] 已记录请求到 {self.log_file}: {request_info.get('method')} {request_info.get('url')}"
+                self._queue.put_nowait(line)
+            except queue.Full:
+                # 队列满说明磁盘已经跟不上了，丢弃这条而不是阻塞请求
+                self._dropped += 1
+                if self._dropped % 1000 == 1:
+                    logger.warning("日志队列已满，累计丢弃 %d 条", self._dropped)
+
+        except Exception as e:
+            logger.error("记录日志时出错: %s", e)
+
+    def _restart_writer_after_fork(self) -> None:
+        """
+        在fork出的子进程中重建写线程
+
+        子进程继承的_queue里只有父进程条目的无用副本，直接换新队列；
+        日志文件fd以O_APPEND打开，多进程同时追加写是安全的。
+        """
+        with self._fork_lock:
+            # 双重检查：多个工作线程可能同时发现pid不匹配
+            if self._writer_pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.QUEUE_MAXSIZE)
+            self._dropped = 0
+            self._writer = threading.Thread(
+                target=self._write_loop, name="log-writer", daemon=True
             )
+            self._writer.start()
+            self._writer_pid = os.getpid()
+
+    def _format_timestamp(self) -> str:
+        """
+        生成ISO-8601时间戳（秒级前缀按秒缓存）
+
+        Returns:
+            str: 形如 2024-01-01T12:00:00.123456 的时间戳
+        """
+        now = time.time()
+        sec = int(now)
+        if sec != self._ts_second:
+            self._ts_second = sec
+            self._ts_prefix = datetime.fromtimestamp(sec).isoformat()
+        return f"{self._ts_prefix}.{int((now - sec) * 1_000_000):06d}"
+
+    def _write_loop(self) -> None:
+        """写线程主循环：取出队列中的行写入文件，批量flush"""
+        while True:
+            item = self._queue.get()
+            if item is _CLOSE:
+                break
+
+            try:
+                self._log_fh.write(item + "\n")
 
+                # 把队列里已经积压的条目一次性排空，再统一flush，
+                # 高负载下多条记录只需要一次系统调用
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _CLOSE:
+                        self._log_fh.flush()
+                        return
+                    self._log_fh.write(item + "\n")
+
+                self._log_fh.flush()
+            except Exception as e:
+                logger.error("写入日志时出错: %s", e)
+
+    def close(self) -> None:
+        """停止写线程并关闭日志文件（排空队列中剩余的条目）"""
+        try:
+            self._queue.put(_CLOSE, timeout=1)
+        except queue.Full:
+            pass
+        self._writer.join(timeout=5)
+        try:
+            self._log_fh.close()
         except Exception as e:
-            print(f"[ERROR] 记录日志时出错: {e}")
+            logger.error("关闭日志文件时出错: %s", e)